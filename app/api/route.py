@@ -1,20 +1,41 @@
 import os
 import sys
 import json
+import math
 import logging
+
+# Must be configured before torch initialises CUDA. Expandable segments let
+# the caching allocator reuse memory across variable-length requests
+# instead of fragmenting it.
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128"
+)
+
 import torch
+import torchaudio
 import gc
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+import hashlib
+import io
+import asyncio
+import threading
+import mmap
+import random
+import wave
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import numpy as np
-from typing import Optional, Dict, Any
+import soundfile
+from typing import Optional, Dict, Any, NamedTuple
+from collections import OrderedDict
 import tempfile
 import shutil
+import subprocess
 import traceback
-from pydub import AudioSegment
 from contextlib import asynccontextmanager
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 from pathlib import Path
 
 # Configure logging
@@ -30,58 +51,456 @@ logger = logging.getLogger(__name__)
 # Global variable for the model
 clap_model = None
 
+# Caption requests waiting to be batched into a single forward pass
+caption_queue = None
+batch_worker = None
+# Single thread that runs the model, keeping it off the event loop
+caption_executor = None
+
+# Reusable tmpfs files that converted audio is written into
+wav_slots = None
+wav_slot_dir = None
+
+# Decoded and resampled waveforms of recent uploads, keyed by content digest
+waveform_cache = OrderedDict()
+waveform_cache_bytes = 0
+waveform_cache_lock = threading.Lock()
+
 # Model configuration
-MODEL_URL = "https://github.com/MadeByKit/sound-classifier-next/releases/download/v1.0.0/clapcap_weights_2023.pth"
+MODEL_URL = os.getenv(
+    "MODEL_URL",
+    "https://github.com/MadeByKit/sound-classifier-next/releases/download/v1.0.0/clapcap_weights_2023.pth"
+)
 MODEL_PATH = Path("clapcap_weights_2023.pth")
+# SHA-256 of the v1.0.0 release asset at MODEL_URL. It could not be computed
+# when this check was added (the asset was unreachable from the build
+# environment); set it from `sha256sum clapcap_weights_2023.pth` of the
+# published release so every deployment verifies the weights by default.
+RELEASE_MODEL_SHA256 = ""
+# Expected SHA-256 of the weights file; MODEL_SHA256 overrides the pin, e.g.
+# when MODEL_URL points at other weights
+MODEL_SHA256 = os.getenv("MODEL_SHA256", RELEASE_MODEL_SHA256)
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Concurrent range requests used when the server supports them
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_TIMEOUT = httpx.Timeout(30.0)
+
+# Requests with a larger body are rejected before it is read
+MAX_AUDIO_BYTES = int(os.getenv("MAX_AUDIO_BYTES", str(100 * 1024 * 1024)))
+# Leading bytes of the container formats accepted for upload
+AUDIO_MAGIC_PREFIXES = (
+    b"ID3",  # MP3 with an ID3 tag
+    b"OggS",  # Ogg Vorbis / Opus
+    b"fLaC",  # FLAC
+    b"\x1aE\xdf\xa3",  # WebM / Matroska (browser recordings)
+)
+
+# Uploads up to this size are converted in memory instead of through temp files
+MAX_IN_MEMORY_BYTES = 10 * 1024 * 1024
+# Larger uploads are copied to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Audio configuration
+SAMPLE_RATE = 44100  # CLAP's native sampling rate
+# Converted audio is written to tmpfs when available so it never hits disk
+TMPFS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# Number of converted-audio files reused across requests
+WAV_SLOT_COUNT = int(os.getenv("WAV_SLOT_COUNT", "16"))
+
+# Compile the caption decoder with torch.compile at startup
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "1") == "1"
 
-def download_model():
+# Caption decoding configuration
+CAPTION_TEMPERATURE = 0.01
+CAPTION_ENTRY_LENGTH = 67
+WARMUP_ENTRY_LENGTH = 8
+MAX_BEAM_SIZE = 5
+# At near-zero temperature beam search is effectively greedy, so a single
+# beam gives the same captions for a fraction of the decoder passes
+DEFAULT_BEAM_SIZE = 1 if CAPTION_TEMPERATURE < 0.05 else 3
+# Fraction of default requests that are also decoded with the previous
+# beam size so rollout can compare the captions in the logs
+LEGACY_BEAM_SIZE = 3
+BEAM_AB_SAMPLE_RATE = float(os.getenv("BEAM_AB_SAMPLE_RATE", "0"))
+
+# Batching configuration
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+MAX_BATCH_DELAY_MS = float(os.getenv("MAX_BATCH_DELAY_MS", "10"))
+
+# Waveform cache configuration. The cache lives in each worker process, so
+# resident memory can reach WAVEFORM_CACHE_MAX_BYTES times the worker count
+# (about 10 MB per minute of cached 44.1 kHz float32 audio). 0 disables it.
+WAVEFORM_CACHE_SIZE = int(os.getenv("WAVEFORM_CACHE_SIZE", "64"))
+WAVEFORM_CACHE_MAX_BYTES = int(os.getenv("WAVEFORM_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+class HashedAudio(NamedTuple):
+    # Audio source tagged with the digest of the uploaded bytes. `waveform`
+    # is set instead of `source` when the upload is already decoded.
+    digest: str
+    source: Any = None
+    waveform: Any = None
+
+async def fetch_range(client, start, end, buffer):
+    async with client.stream(
+        "GET", MODEL_URL, headers={"Range": f"bytes={start}-{end}"}
+    ) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RuntimeError("server ignored the range request")
+        offset = start
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            buffer[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+    if offset != end + 1:
+        raise RuntimeError(f"incomplete download of bytes {start}-{end}")
+
+async def download_ranges(client, size, path):
+    # Fetch the file as parallel ranges straight into a preallocated mapping
+    with open(path, 'wb+') as f:
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as buffer:
+            part_size = -(-size // DOWNLOAD_CONNECTIONS)
+            tasks = [
+                asyncio.create_task(
+                    fetch_range(client, start, min(start + part_size, size) - 1, buffer)
+                )
+                for start in range(0, size, part_size)
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Stop the other ranges before the mapping is closed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            buffer.flush()
+            # Ranges arrive out of order, so hash once everything is in place
+            return hashlib.sha256(buffer).hexdigest()
+
+async def download_stream(client, size, path):
+    # Stream the model file to disk, hashing it as it arrives
+    hasher = hashlib.sha256()
+    async with client.stream("GET", MODEL_URL) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                hasher.update(chunk)
+            written = f.tell()
+    if size and written != size:
+        raise RuntimeError(f"incomplete download ({written} of {size} bytes)")
+    return hasher.hexdigest()
+
+async def download_model():
     if not MODEL_PATH.exists():
         logger.info("Downloading model from GitHub releases...")
+        partial_path = MODEL_PATH.with_name(MODEL_PATH.name + ".part")
         try:
-            response = requests.get(MODEL_URL, stream=True)
-            response.raise_for_status()
+            async with httpx.AsyncClient(
+                http2=True, follow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+            ) as client:
+                head = await client.head(MODEL_URL)
+                head.raise_for_status()
+                size = int(head.headers.get("content-length", 0))
+                if size and head.headers.get("accept-ranges", "none").lower() == "bytes":
+                    digest = await download_ranges(client, size, partial_path)
+                else:
+                    digest = await download_stream(client, size, partial_path)
+            
+            if not MODEL_SHA256:
+                logger.warning(
+                    "No pinned SHA-256 for the model weights; "
+                    "the download could not be verified"
+                )
+            elif digest != MODEL_SHA256.lower():
+                raise ValueError(
+                    f"checksum mismatch (expected {MODEL_SHA256}, got {digest})"
+                )
             
-            # Save the model file
-            with open(MODEL_PATH, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            logger.info("Model downloaded successfully")
+            # Only expose the file under its final name once it is complete
+            os.replace(partial_path, MODEL_PATH)
+            logger.info(f"Model downloaded successfully (sha256 {digest})")
         except Exception as e:
+            if partial_path.exists():
+                partial_path.unlink()
             logger.error(f"Failed to download model: {str(e)}")
             raise RuntimeError(f"Failed to download model: {str(e)}")
 
-def load_model():
+def _import_clap():
+    # Importing msclap pulls in transformers and friends, which takes seconds
+    from msclap import CLAP
+    return CLAP
+
+def is_audio_header(head):
+    if head.startswith(AUDIO_MAGIC_PREFIXES):
+        return True
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return True
+    if head[:4] == b"FORM" and head[8:12] in (b"AIFF", b"AIFC"):
+        return True
+    if head[4:8] == b"ftyp":  # MP4 / M4A
+        return True
+    # Bare MPEG audio frame sync (MP3 without a tag, ADTS AAC)
+    return len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0
+
+def decode_audio(source):
+    # Decode with libsndfile and resample with torchaudio. Channels are kept
+    # as (C, T), like torchaudio.load in read_audio, so multichannel audio is
+    # flattened by load_audio_into_tensor just as before rather than downmixed
+    data, sample_rate = soundfile.read(source, dtype="float32", always_2d=True)
+    waveform = torch.from_numpy(np.ascontiguousarray(data.T))
+    if sample_rate != SAMPLE_RATE:
+        waveform = torchaudio.functional.resample(waveform, sample_rate, SAMPLE_RATE)
+    return waveform, SAMPLE_RATE
+
+def convert_to_wav(input_path, wav_path):
+    # Transcode straight to WAV at CLAP's sampling rate, so the model does
+    # not have to resample it again. The channel layout is kept, as pydub
+    # did, since CLAP folds the channels itself.
+    result = subprocess.run(
+        [
+            "ffmpeg", "-loglevel", "error", "-y",
+            "-i", input_path,
+            "-ar", str(SAMPLE_RATE),
+            "-f", "wav", wav_path
+        ],
+        capture_output=True
+    )
+    if result.returncode != 0:
+        stderr = result.stderr.decode(errors="replace").strip()
+        raise RuntimeError(f"ffmpeg failed to convert audio: {stderr}")
+
+def create_wav_slots(count):
+    # Allocate the conversion targets once, so requests never create or
+    # unlink files; ffmpeg truncates a slot when it writes into it
+    global wav_slot_dir
+    wav_slot_dir = tempfile.mkdtemp(prefix="clap_slots_", dir=TMPFS_DIR)
+    slots = asyncio.Queue()
+    for i in range(count):
+        path = os.path.join(wav_slot_dir, f"slot_{i}.wav")
+        open(path, "wb").close()
+        slots.put_nowait(path)
+    return slots
+
+def release_wav_slot(wav_slot):
+    # Drop the previous conversion so an idle slot does not pin its RAM on tmpfs
+    os.truncate(wav_slot, 0)
+    wav_slots.put_nowait(wav_slot)
+
+def release_conversion(task, input_path, wav_slot):
+    # Runs once an abandoned ffmpeg conversion has finished with its files
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Abandoned conversion failed: {task.exception()}")
+    if os.path.exists(input_path):
+        os.unlink(input_path)
+    release_wav_slot(wav_slot)
+
+def when_all_done(futures, callback):
+    remaining = len(futures)
+    
+    def on_done(_):
+        nonlocal remaining
+        remaining -= 1
+        if remaining == 0:
+            callback()
+    
+    for future in futures:
+        future.add_done_callback(on_done)
+
+def save_upload(source, destination):
+    # Copy in bounded chunks, hashing along the way, so peak memory does not
+    # depend on the size of the upload
+    hasher = hashlib.blake2b(digest_size=16)
+    while chunk := source.read(UPLOAD_CHUNK_SIZE):
+        destination.write(chunk)
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+def get_cached_waveform(digest):
+    with waveform_cache_lock:
+        waveform = waveform_cache.get(digest)
+        if waveform is not None:
+            waveform_cache.move_to_end(digest)
+        return waveform
+
+def cache_waveform(digest, waveform):
+    global waveform_cache_bytes
+    size = waveform[0].element_size() * waveform[0].nelement()
+    if size > WAVEFORM_CACHE_MAX_BYTES:
+        return
+    with waveform_cache_lock:
+        if digest in waveform_cache:
+            return
+        waveform_cache[digest] = waveform
+        waveform_cache_bytes += size
+        # Evict least recently used entries until back within limits
+        while (len(waveform_cache) > WAVEFORM_CACHE_SIZE
+               or waveform_cache_bytes > WAVEFORM_CACHE_MAX_BYTES):
+            _, evicted = waveform_cache.popitem(last=False)
+            waveform_cache_bytes -= evicted[0].element_size() * evicted[0].nelement()
+
+def install_waveform_cache(model):
+    # CLAP decodes and resamples every file in read_audio before computing
+    # its features; serve repeated uploads from the cache instead
+    read_audio = model.read_audio
+    
+    def cached_read_audio(audio_path, resample=True):
+        if not isinstance(audio_path, HashedAudio):
+            return read_audio(audio_path, resample=resample)
+        if audio_path.waveform is not None:
+            return audio_path.waveform
+        waveform = get_cached_waveform(audio_path.digest)
+        if waveform is None:
+            waveform = read_audio(audio_path.source, resample=resample)
+            cache_waveform(audio_path.digest, waveform)
+        return waveform
+    
+    model.read_audio = cached_read_audio
+
+def install_pinned_preprocessing(model):
+    # msclap copies each clip to the GPU on its own from pageable memory;
+    # stack the batch on the host and copy it once from pinned memory so
+    # the transfer is a single asynchronous DMA
+    def preprocess_audio(audio_files, resample):
+        audio_tensors = [
+            model.load_audio_into_tensor(audio_file, model.args.duration, resample).reshape(1, -1)
+            for audio_file in audio_files
+        ]
+        batch = torch.stack(audio_tensors).pin_memory()
+        return batch.to("cuda", non_blocking=True)
+    
+    model.preprocess_audio = preprocess_audio
+
+def install_fp16_decoder(model):
+    # Only the GPT-2 decoder runs under FP16 autocast. The audio frontend's
+    # power spectrogram exceeds the FP16 range for loud or clipped input,
+    # which turns the mel bands into inf and the caption into garbage.
+    generate_beam = model._generate_beam
+    
+    def fp16_generate_beam(*args, **kwargs):
+        with torch.autocast(device_type="cuda", dtype=torch.float16):
+            return generate_beam(*args, **kwargs)
+    
+    model._generate_beam = fp16_generate_beam
+
+def compile_decoder(model):
+    # msclap drives the GPT-2 decoder once per token and beam, so that is
+    # where per-op Python dispatch overhead adds up. The sequence grows by
+    # one token per step, hence dynamic shapes.
+    decoder = model.clapcap.gpt
+    model.clapcap.gpt = torch.compile(decoder, dynamic=True)
+    # Compilation happens lazily, during the warm-up. Dynamo specialises a
+    # batch of one beam, while wider beams share the dynamic graph, so trace
+    # both rather than recompiling on the first A/B or beam >= 2 request
+    warmup_beam_sizes = sorted({1, DEFAULT_BEAM_SIZE, LEGACY_BEAM_SIZE})
+    if not all(warm_up_model(size) for size in warmup_beam_sizes):
+        logger.warning("Compiled decoder failed to warm up, using eager mode")
+        model.clapcap.gpt = decoder
+        warm_up_model()
+
+def warm_up_model(beam_size=DEFAULT_BEAM_SIZE):
+    # Caption a second of silence so the first real request does not pay
+    # for lazy initialisation (audio backend, kernels, compilation). The
+    # WAV goes through torchaudio like the ffmpeg fallback output does.
+    silence = io.BytesIO()
+    with wave.open(silence, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(b"\0\0" * SAMPLE_RATE)
+    try:
+        generate_captions(
+            [HashedAudio("warmup", silence)],
+            beam_size,
+            entry_length=WARMUP_ENTRY_LENGTH
+        )
+        return True
+    except Exception as e:
+        logger.warning(f"Model warm-up failed: {str(e)}")
+        return False
+
+def available_cpus():
+    # os.cpu_count() reports the host's cores, not what this container may
+    # use, so honour the affinity mask and any cgroup CPU quota
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0 and period > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+async def load_model(compile_model=True):
     global clap_model
     try:
         logger.info("Starting up the application...")
         
-        # Clear any existing model and free memory
+        # Clear any existing model; on CUDA also hand its memory back once,
+        # so the new copy is not loaded next to the old one
         if clap_model is not None:
-            del clap_model
-            gc.collect()
-            torch.cuda.empty_cache()
+            clap_model = None
+            if torch.cuda.is_available():
+                gc.collect()
+                torch.cuda.empty_cache()
         
-        # Download model if it doesn't exist
-        download_model()
+        # Download model if it doesn't exist, overlapping the network I/O
+        # with the heavy CLAP import
+        download_task = asyncio.create_task(download_model())
+        import_task = asyncio.create_task(asyncio.to_thread(_import_clap))
+        _, CLAP = await asyncio.gather(download_task, import_task)
         
         # Check if CUDA is available
         use_cuda = torch.cuda.is_available()
         logger.info(f"CUDA available: {use_cuda}")
         
-        # Set memory allocation strategy
+        # Let intra-op parallelism use the available cores on CPU, but keep
+        # a single inter-op thread to bound memory use
         if not use_cuda:
-            torch.set_num_threads(1)  # Limit CPU threads
-            os.environ['OMP_NUM_THREADS'] = '1'
-            os.environ['MKL_NUM_THREADS'] = '1'
+            num_threads = int(os.getenv("TORCH_NUM_THREADS", min(available_cpus(), 8)))
+            torch.set_num_threads(num_threads)
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # Can only be set once, before any inter-op work has started
+                pass
+            logger.info(f"Using {num_threads} CPU threads")
         
         # Initialize CLAP model
         logger.info("Loading CLAP model...")
-        from msclap import CLAP
         clap_model = CLAP(
             version='clapcap',
             use_cuda=use_cuda,
             model_fp=str(MODEL_PATH)
         )
+        install_waveform_cache(clap_model)
+        if use_cuda:
+            install_pinned_preprocessing(clap_model)
+        use_fp16 = use_cuda and torch.cuda.get_device_capability()[0] >= 7
+        if use_fp16:
+            install_fp16_decoder(clap_model)
+        logger.info(f"FP16 decoder autocast enabled: {use_fp16}")
+        logger.info("Warming up model...")
+        if TORCH_COMPILE and compile_model:
+            compile_decoder(clap_model)
+        else:
+            warm_up_model()
         logger.info("CLAP model loaded successfully")
         return True
     except Exception as e:
@@ -89,19 +508,103 @@ def load_model():
         logger.error(traceback.format_exc())
         return False
 
+def generate_captions(audio_sources, beam_size, entry_length=CAPTION_ENTRY_LENGTH):
+    for audio in audio_sources:
+        # In-memory buffers may already have been read by a failed batch
+        if isinstance(audio.source, io.BytesIO):
+            audio.source.seek(0)
+    with torch.inference_mode():
+        return clap_model.generate_caption(
+            audio_sources,
+            resample=True,
+            beam_size=beam_size,
+            entry_length=entry_length,
+            temperature=CAPTION_TEMPERATURE
+        )
+
+def caption_batch(audio_sources, beam_size):
+    # Runs on the caption executor; returns a caption or an exception per item
+    try:
+        return generate_captions(audio_sources, beam_size)
+    except Exception as e:
+        if len(audio_sources) == 1:
+            return [e]
+        # Retry one by one so a single bad upload does not fail
+        # every request it was batched with
+        logger.warning(f"Batch captioning failed, retrying individually: {str(e)}")
+        results = []
+        for audio in audio_sources:
+            try:
+                results.extend(generate_captions([audio], beam_size))
+            except Exception as item_error:
+                results.append(item_error)
+        return results
+
+def resolve_batch(batch, results):
+    for (_, _, future), result in zip(batch, results):
+        if future.done():
+            continue
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+async def run_caption_batches():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await caption_queue.get()]
+        # Give concurrent requests a short window to join this batch
+        await asyncio.sleep(MAX_BATCH_DELAY_MS / 1000)
+        while len(batch) < MAX_BATCH_SIZE and not caption_queue.empty():
+            batch.append(caption_queue.get_nowait())
+        
+        # The beam size applies to a whole generate_caption call
+        by_beam_size = {}
+        for item in batch:
+            by_beam_size.setdefault(item[1], []).append(item)
+        for beam_size, items in by_beam_size.items():
+            logger.info(f"Generating captions for a batch of {len(items)} (beam size {beam_size})")
+            results = await loop.run_in_executor(
+                caption_executor, caption_batch, [audio for audio, _, _ in items], beam_size
+            )
+            resolve_batch(items, results)
+
+def log_beam_comparison(future, legacy_future, beam_size):
+    if future.cancelled() or future.exception() is not None:
+        return
+    if legacy_future.cancelled():
+        return
+    if legacy_future.exception() is not None:
+        logger.warning(f"Beam A/B: legacy decode failed: {str(legacy_future.exception())}")
+        return
+    caption, legacy_caption = future.result(), legacy_future.result()
+    logger.info(
+        f"Beam A/B: beam_size={beam_size} "
+        f"{'matches' if caption == legacy_caption else 'differs from'} "
+        f"beam_size={LEGACY_BEAM_SIZE}: {caption!r} vs {legacy_caption!r}"
+    )
+
+def enqueue_caption(audio, beam_size):
+    future = asyncio.get_running_loop().create_future()
+    caption_queue.put_nowait((audio, beam_size, future))
+    return future
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load the model on startup
-    if not load_model():
+    global caption_queue, batch_worker, caption_executor, wav_slots
+    # Load the model on startup, unless it was preloaded before forking
+    if clap_model is None and not await load_model():
         logger.error("Failed to load model during startup")
         raise Exception("Failed to load model")
+    wav_slots = create_wav_slots(WAV_SLOT_COUNT)
+    caption_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="caption")
+    caption_queue = asyncio.Queue()
+    batch_worker = asyncio.create_task(run_caption_batches())
     yield
-    # Clean up on shutdown
-    global clap_model
-    if clap_model is not None:
-        del clap_model
-        gc.collect()
-        torch.cuda.empty_cache()
+    # Clean up on shutdown; the model is left for process exit to reclaim
+    batch_worker.cancel()
+    caption_executor.shutdown(wait=False)
+    shutil.rmtree(wav_slot_dir, ignore_errors=True)
 
 app = FastAPI(
     title="Audio Captioning API",
@@ -110,6 +613,22 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # FastAPI parses the whole multipart body before the handler runs, so
+    # oversized uploads have to be turned away here
+    if request.method == "POST":
+        try:
+            content_length = int(request.headers.get("content-length", "0"))
+        except ValueError:
+            content_length = 0
+        if content_length > MAX_AUDIO_BYTES:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"Upload exceeds the {MAX_AUDIO_BYTES} byte limit."}
+            )
+    return await call_next(request)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -135,7 +654,8 @@ async def health_check():
 @app.post("/process-audio")
 async def process_audio(
     audio_file: UploadFile = File(...),
-    industry: Optional[str] = Form(None)
+    industry: Optional[str] = Form(None),
+    beam_size: Optional[int] = Form(None)
 ):
     if not clap_model:
         raise HTTPException(
@@ -143,47 +663,124 @@ async def process_audio(
             detail="Model not initialized. Please try again later."
         )
     
+    if beam_size is None:
+        beam_size = DEFAULT_BEAM_SIZE
+    elif not 1 <= beam_size <= MAX_BEAM_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"beam_size must be between 1 and {MAX_BEAM_SIZE}."
+        )
+    
+    # Sniff the container from the first bytes before doing any real work
+    head = await audio_file.read(12)
+    if not is_audio_header(head):
+        raise HTTPException(
+            status_code=415,
+            detail="Unsupported file type. Please upload an audio file."
+        )
+    await audio_file.seek(0)
+    
     temp_path = None
-    wav_path = None
+    wav_slot = None
     
     try:
         logger.info(f"Received file: {audio_file.filename}")
         logger.info(f"Content type: {audio_file.content_type}")
         
-        # Create temporary file with original extension
         file_extension = os.path.splitext(audio_file.filename)[1].lower()
-        with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as temp_file:
-            temp_path = temp_file.name
-            # Save uploaded file to temporary location
-            with open(temp_path, "wb") as buffer:
-                shutil.copyfileobj(audio_file.file, buffer)
         
-        # Convert audio to WAV using pydub
-        audio = AudioSegment.from_file(temp_path)
-        wav_path = temp_path + ".wav"
-        audio.export(wav_path, format="wav")
+        in_memory = audio_file.size is not None and audio_file.size <= MAX_IN_MEMORY_BYTES
         
-        # Clean up the original temp file
-        os.unlink(temp_path)
-        temp_path = None
+        if in_memory:
+            # Keep small uploads in memory; soundfile reads them directly
+            content = await audio_file.read()
+            digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        else:
+            # Create temporary file with original extension
+            with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as temp_file:
+                temp_path = temp_file.name
+                # Save uploaded file to temporary location off the event loop
+                digest = await asyncio.to_thread(save_upload, audio_file.file, temp_file)
+        
+        cached_waveform = get_cached_waveform(digest)
+        if cached_waveform is not None:
+            # Seen this exact upload recently; skip decoding altogether
+            logger.info("Using cached waveform")
+            audio = HashedAudio(digest, waveform=cached_waveform)
+        else:
+            try:
+                # Common formats (WAV, FLAC, OGG, MP3) decode natively, with
+                # no subprocess and no intermediate WAV for CLAP to re-read
+                waveform = await asyncio.to_thread(
+                    decode_audio, io.BytesIO(content) if in_memory else temp_path
+                )
+            except soundfile.SoundFileError:
+                waveform = None
+            
+            if waveform is not None:
+                cache_waveform(digest, waveform)
+                audio = HashedAudio(digest, waveform=waveform)
+            else:
+                # Fall back to ffmpeg for codecs libsndfile cannot read,
+                # converting into a free slot
+                if in_memory:
+                    # ffmpeg needs a seekable input: MP4/M4A files with the
+                    # moov atom at the end cannot be demuxed from a pipe
+                    with tempfile.NamedTemporaryFile(
+                        suffix=file_extension, dir=wav_slot_dir, delete=False
+                    ) as temp_file:
+                        temp_path = temp_file.name
+                        temp_file.write(content)
+                wav_slot = await wav_slots.get()
+                conversion = asyncio.ensure_future(
+                    asyncio.to_thread(convert_to_wav, temp_path, wav_slot)
+                )
+                try:
+                    await asyncio.shield(conversion)
+                except asyncio.CancelledError:
+                    # The thread running ffmpeg cannot be cancelled, so the
+                    # slot and input file are released only once it exits
+                    slot, input_path = wav_slot, temp_path
+                    wav_slot = temp_path = None
+                    conversion.add_done_callback(
+                        lambda task: release_conversion(task, input_path, slot)
+                    )
+                    raise
+                # Clean up the original temp file
+                os.unlink(temp_path)
+                temp_path = None
+                audio = HashedAudio(digest, wav_slot)
         
         # Generate caption using CLAP model
         logger.info("Generating caption...")
-        captions = clap_model.generate_caption(
-            [wav_path],
-            resample=True,
-            beam_size=3,
-            entry_length=67,
-            temperature=0.01
-        )
+        future = enqueue_caption(audio, beam_size)
+        queued = [future]
+        if beam_size != LEGACY_BEAM_SIZE and random.random() < BEAM_AB_SAMPLE_RATE:
+            # Rollout check: also decode with the previous beam size and log
+            # the comparison once both are done, without delaying the reply
+            legacy_future = enqueue_caption(audio, LEGACY_BEAM_SIZE)
+            queued.append(legacy_future)
+            when_all_done(
+                queued, lambda: log_beam_comparison(future, legacy_future, beam_size)
+            )
+        if wav_slot:
+            # The queued decodes read from the slot, so it is handed back
+            # only once they have run, even if this request is cancelled
+            slot = wav_slot
+            when_all_done(queued, lambda: release_wav_slot(slot))
+            wav_slot = None
         
-        if not captions or not isinstance(captions, list) or not captions[0]:
+        # Shielded so that a cancelled request leaves its queued future
+        # pending until the batch worker has actually processed it
+        caption = await asyncio.shield(future)
+        
+        if not caption:
             raise HTTPException(
                 status_code=500,
                 detail="Failed to generate caption. Please try again."
             )
         
-        caption = str(captions[0])
+        caption = str(caption)
         logger.info(f"Generated caption: {caption}")
         
         return {
@@ -199,16 +796,60 @@ async def process_audio(
             detail=f"Error processing audio: {str(e)}"
         )
     finally:
-        # Clean up any remaining temporary files
+        # Clean up any remaining temporary files, and hand back a slot that
+        # never made it into the queue
         if temp_path and os.path.exists(temp_path):
             os.unlink(temp_path)
-        if wav_path and os.path.exists(wav_path):
-            os.unlink(wav_path)
+        if wav_slot:
+            release_wav_slot(wav_slot)
+
+def run_preforked(workers):
+    # Load the model once in the parent so forked workers share its weights
+    # copy-on-write. The parent keeps torch to one thread and only warms up
+    # in eager mode: torch.compile starts inductor's compile worker pool,
+    # which must not be inherited across fork, so each worker compiles its
+    # own decoder after forking.
+    from gunicorn.app.base import BaseApplication
+    
+    threads_per_worker = max(1, available_cpus() // workers)
+    
+    def post_fork(server, worker):
+        torch.set_num_threads(threads_per_worker)
+        if TORCH_COMPILE:
+            compile_decoder(clap_model)
+    
+    class PreforkedApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", "0.0.0.0:8000")
+            self.cfg.set("workers", workers)
+            self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("loglevel", "info")
+            self.cfg.set("post_fork", post_fork)
+            # Compiling the decoder in a fresh worker can outlast the
+            # default 30 s heartbeat before the worker starts notifying
+            self.cfg.set("timeout", 300)
+        
+        def load(self):
+            return app
+    
+    os.environ["TORCH_NUM_THREADS"] = "1"
+    if not asyncio.run(load_model(compile_model=False)):
+        raise Exception("Failed to load model")
+    logger.info(f"Starting {workers} workers with {threads_per_worker} threads each")
+    PreforkedApplication().run()
 
 if __name__ == "__main__":
     import uvicorn
     try:
-        uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+        # A CUDA context cannot be shared across fork, so GPU hosts keep a
+        # single process
+        default_workers = 1 if torch.cuda.is_available() else available_cpus()
+        workers = int(os.getenv("WEB_CONCURRENCY", default_workers))
+        if workers > 1 and not torch.cuda.is_available():
+            run_preforked(workers)
+        else:
+            uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
     except Exception as e:
         logger.error(f"Server error: {str(e)}")
         logger.error(traceback.format_exc())
@@ -0,0 +1,79 @@
+import math
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app" / "api"))
+import route  # noqa: E402
+
+requires_cuda = pytest.mark.skipif(
+    not torch.cuda.is_available(), reason="FP16 autocast needs CUDA"
+)
+
+
+class RecordingModel:
+    # Stands in for CLAP and records whether autocast was active in the
+    # audio frontend and in the decoder
+    def __init__(self):
+        self.autocast = {}
+
+    def generate_caption(self, audio_files, **kwargs):
+        self.autocast["frontend"] = torch.is_autocast_enabled()
+        self._generate_beam()
+        return ["Caption"] * len(audio_files)
+
+    def _generate_beam(self, *args, **kwargs):
+        self.autocast["decoder"] = torch.is_autocast_enabled()
+        return ["caption"]
+
+
+@requires_cuda
+def test_fp16_autocast_covers_only_the_decoder(monkeypatch):
+    model = RecordingModel()
+    route.install_fp16_decoder(model)
+    monkeypatch.setattr(route, "clap_model", model)
+
+    route.generate_captions([route.HashedAudio("test")], beam_size=1)
+
+    assert model.autocast == {"frontend": False, "decoder": True}
+
+
+def full_scale_sine():
+    # Centred on an STFT bin (n_fft=1024), so its power peaks at 65536
+    t = torch.arange(route.SAMPLE_RATE) / route.SAMPLE_RATE
+    return torch.sin(2 * math.pi * 23 * route.SAMPLE_RATE / 1024 * t)
+
+
+def clipped_square():
+    t = torch.arange(route.SAMPLE_RATE) / route.SAMPLE_RATE
+    return torch.sign(torch.sin(2 * math.pi * 100 * t))
+
+
+@requires_cuda
+@pytest.mark.skipif(not route.MODEL_PATH.exists(), reason="model weights not downloaded")
+@pytest.mark.parametrize("make_clip", [full_scale_sine, clipped_square])
+def test_full_scale_audio_stays_finite_through_the_audio_encoder(monkeypatch, make_clip):
+    from msclap import CLAP
+
+    model = CLAP(version="clapcap", use_cuda=True, model_fp=str(route.MODEL_PATH))
+    route.install_waveform_cache(model)
+    route.install_pinned_preprocessing(model)
+    route.install_fp16_decoder(model)
+    monkeypatch.setattr(route, "clap_model", model)
+
+    embeddings = []
+    hook = model.clapcap.clap.register_forward_hook(
+        lambda module, inputs, output: embeddings.append(output[0])
+    )
+    try:
+        waveform = (make_clip().unsqueeze(0), route.SAMPLE_RATE)
+        captions = route.generate_captions(
+            [route.HashedAudio("full-scale", waveform=waveform)], beam_size=1
+        )
+    finally:
+        hook.remove()
+
+    assert embeddings and all(torch.isfinite(e).all() for e in embeddings)
+    assert captions and captions[0]
\ No newline at end of file